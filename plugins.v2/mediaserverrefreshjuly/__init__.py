@@ -1,8 +1,15 @@
+import os
+import threading
 import time
+from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
-from hashlib import sha1
+from hashlib import blake2b
 from typing import Any, List, Dict, Tuple, Optional
 
+import pytz
+from apscheduler.schedulers.background import BackgroundScheduler
+
 from app.core.context import MediaInfo
 from app.core.event import eventmanager, Event
 from app.helper.mediaserver import MediaServerHelper
@@ -13,6 +20,14 @@ from app.schemas.types import EventType, MediaType
 from app.core.config import settings
 
 
+@lru_cache(maxsize=1024)
+def _path_key(path: str) -> str:
+    """
+    计算目录路径对应的锁文件名，同一目录重复入库时直接命中缓存
+    """
+    return blake2b(path.encode("utf-8"), digest_size=16).hexdigest()
+
+
 class MediaServerRefreshJuly(_PluginBase):
     # 插件名称
     plugin_name = "媒体库服务器刷新"
@@ -21,7 +36,7 @@ class MediaServerRefreshJuly(_PluginBase):
     # 插件图标
     plugin_icon = "refresh2.png"
     # 插件版本
-    plugin_version = "3.2.1"
+    plugin_version = "3.3.0"
     # 插件作者
     plugin_author = "jxxghp,july"
     # 作者主页
@@ -36,22 +51,94 @@ class MediaServerRefreshJuly(_PluginBase):
     # 私有属性
     mediaserver_helper = None
     _enabled = False
-    _delay = 0
+    _delay = 0.0
     _mediaservers = None
     _tv_lock_mode = "parent"
+    _lock_dir: Path = None
+    _lock_dir_str: str = None
+    _scheduler: Optional[BackgroundScheduler] = None
+    # 延迟窗口内待刷新的条目，按加锁目录汇总
+    _pending_items: Dict[str, List[RefreshMediaItem]] = None
+    # 进程内已加锁目录的执行时间，命中时无需访问锁文件
+    _pending_runtimes: Dict[str, float] = None
+    _pending_lock = threading.Lock()
+    # 服务信息缓存，避免每个事件都重新获取并探测连接状态
+    _cached_services: Optional[Dict[str, ServiceInfo]] = None
+    _cached_at = 0.0
+    _services_cache_ttl = 5.0
+    # 各服务器支持的刷新方式，首次见到时探测一次，刷新时查表分发
+    _service_caps: Dict[str, str] = None
+    # 配置页面静态骨架，只在初始化时构建一次
+    _form_template: List[dict] = None
+    _form_mediaserver_props: dict = None
+    # 是否已把装饰器注册的监听从事件分发器上摘掉
+    _listener_removed = False
 
     def init_plugin(self, config: dict = None):
         self.mediaserver_helper = MediaServerHelper()
+        # 锁目录只在初始化时构造并创建一次，事件处理时无需再拼路径和 mkdir
+        self._lock_dir = Path(settings.CONFIG_PATH) / "media_refresh_lock"
+        self._lock_dir.mkdir(parents=True, exist_ok=True)
+        self._lock_dir_str = str(self._lock_dir)
+        self.__build_form_template()
         if config:
             self._enabled = config.get("enabled")
-            self._delay = config.get("delay") or 0
+            # 表单里拿到的是字符串，初始化时转好，事件处理不再每次 float()
+            try:
+                self._delay = float(config.get("delay") or 0)
+            except (TypeError, ValueError):
+                self._delay = 0.0
             self._mediaservers = config.get("mediaservers") or []
             self._tv_lock_mode = config.get("tv_lock_mode") or "parent"
 
+        # 停止现有服务
+        self.stop_service()
+
+        self._pending_items = {}
+        self._pending_runtimes = {}
+        # 配置变更后强制下次重新获取服务信息
+        self._cached_at = 0.0
+        self._cached_services = None
+        self._service_caps = {}
+        if self._enabled:
+            # 宽松的 misfire 宽限期：批量入库时任务可能排队超过默认 1 秒，宁可晚刷也不能漏刷
+            self._scheduler = BackgroundScheduler(timezone=settings.TZ,
+                                                  job_defaults={"misfire_grace_time": 300})
+            # 定期清理过期锁文件，避免锁目录无限增长
+            self._scheduler.add_job(self.__gc_locks, "interval",
+                                    hours=1,
+                                    id="media_refresh_lock_gc")
+            self._scheduler.start()
+
+        # 禁用时把装饰器注册的监听从事件分发器上摘掉，事件连本插件都不会进入；
+        # 重新启用时把同一个函数对象挂回去，且仅在确实摘掉过时再挂，避免重复注册
+        try:
+            if not self._enabled:
+                if not self._listener_removed and hasattr(eventmanager, "remove_event_listener"):
+                    eventmanager.remove_event_listener(EventType.TransferComplete, type(self).refresh)
+                    self._listener_removed = True
+            elif self._listener_removed:
+                if hasattr(eventmanager, "add_event_listener"):
+                    eventmanager.add_event_listener(EventType.TransferComplete, type(self).refresh)
+                self._listener_removed = False
+        except Exception as e:
+            logger.debug(f"调整事件监听失败: {e}")
+
     @property
     def service_infos(self) -> Optional[Dict[str, ServiceInfo]]:
         """
-        服务信息
+        服务信息（短TTL缓存，同一批量入库只探测一次）
+        """
+        if self._cached_at and time.monotonic() - self._cached_at <= self._services_cache_ttl:
+            return self._cached_services
+        services = self.__fetch_service_infos()
+        self._cached_services = services
+        self._cached_at = time.monotonic()
+        return services
+
+    def __fetch_service_infos(self) -> Optional[Dict[str, ServiceInfo]]:
+        """
+        获取并筛选已连接的媒体服务器
         """
         if not self._mediaservers:
             logger.warning("尚未配置媒体服务器，请检查配置")
@@ -68,6 +155,13 @@ class MediaServerRefreshJuly(_PluginBase):
                 logger.warning(f"媒体服务器 {service_name} 未连接，请检查配置")
             else:
                 active_services[service_name] = service_info
+                if service_name not in self._service_caps:
+                    instance = service_info.instance
+                    self._service_caps[service_name] = (
+                        "items" if hasattr(instance, "refresh_library_by_items")
+                        else "root" if hasattr(instance, "refresh_root_library")
+                        else "none"
+                    )
 
         if not active_services:
             logger.warning("没有已连接的媒体服务器，请检查配置")
@@ -89,7 +183,30 @@ class MediaServerRefreshJuly(_PluginBase):
         """
         拼装插件配置页面，需要返回两块数据：1、页面配置；2、数据结构
         """
-        return [
+        if self._form_template is None:
+            self.__build_form_template()
+        # 只有媒体服务器选项依赖运行时状态，其余骨架复用
+        self._form_mediaserver_props['items'] = [{"title": config.name, "value": config.name}
+                                                 for config in self.mediaserver_helper.get_configs().values()]
+        return self._form_template, {
+            "enabled": False,
+            "delay": 0,
+            "tv_lock_mode": "parent"
+        }
+
+    def __build_form_template(self):
+        """
+        构建配置页面静态骨架，并记下需要动态填充的媒体服务器选项
+        """
+        self._form_mediaserver_props = {
+            'multiple': True,
+            'chips': True,
+            'clearable': True,
+            'model': 'mediaservers',
+            'label': '媒体服务器',
+            'items': []
+        }
+        self._form_template = [
             {
                 'component': 'VForm',
                 'content': [
@@ -125,15 +242,7 @@ class MediaServerRefreshJuly(_PluginBase):
                                 'content': [
                                     {
                                         'component': 'VSelect',
-                                        'props': {
-                                            'multiple': True,
-                                            'chips': True,
-                                            'clearable': True,
-                                            'model': 'mediaservers',
-                                            'label': '媒体服务器',
-                                            'items': [{"title": config.name, "value": config.name}
-                                                      for config in self.mediaserver_helper.get_configs().values()]
-                                        }
+                                        'props': self._form_mediaserver_props
                                     }
                                 ]
                             }
@@ -186,23 +295,24 @@ class MediaServerRefreshJuly(_PluginBase):
                     }
                 ]
             }
-        ], {
-            "enabled": False,
-            "delay": 0,
-            "tv_lock_mode": "parent"
-        }
+        ]
 
     def get_page(self) -> List[dict]:
         pass
 
+    # 默认参数把热路径用到的全局函数预绑定为局部变量
     @eventmanager.register(EventType.TransferComplete)
-    def refresh(self, event: Event):
+    def refresh(self, event: Event,
+                _time=time.time, _strftime=time.strftime, _localtime=time.localtime, _Path=Path):
         """
-        发送通知消息
+        入库完成后刷新媒体库
         """
         if not self._enabled:
             return
 
+        log_info = logger.info
+        log_debug = logger.debug
+
         event_info: dict = event.event_data
         if not event_info:
             return
@@ -218,69 +328,149 @@ class MediaServerRefreshJuly(_PluginBase):
 
         mediainfo: MediaInfo = event_info.get("mediainfo")
 
-        if self._delay:
-            delay = float(self._delay)
+        # 加锁逻辑用原始字符串，Path 只在交给 RefreshMediaItem 时构造一次
+        target_path_str = transferinfo.target_diritem.path
+        target_path = _Path(target_path_str)
+        items = [
+            RefreshMediaItem(
+                title=mediainfo.title,
+                year=mediainfo.year,
+                type=mediainfo.type,
+                category=mediainfo.category,
+                target_path=target_path
+            )
+        ]
 
-            target_path = Path(transferinfo.target_diritem.path)
+        if self._delay > 0 and self._scheduler:
             if mediainfo.type == MediaType.TV and self._tv_lock_mode == "current":
-                logger.info("媒体类型为剧集，且选择为当前目录加锁")
+                log_debug("媒体类型为剧集，且选择为当前目录加锁")
+                lock_target = target_path_str
             else:
-                target_path = target_path.parent
+                lock_target = os.path.dirname(target_path_str)
+
+            log_debug(f"加锁目录: {lock_target}")
+            target_path_hash = _path_key(lock_target)
 
-            logger.info(f"加锁目录: {target_path}")
-            target_path_hash = sha1(str(target_path).encode()).hexdigest()
-            
-            temp_path = Path(settings.CONFIG_PATH)
-            lock_path = temp_path / "media_refresh_lock" / f"{target_path_hash}.lock"
-            logger.info(f"锁定文件路径: {lock_path}")
+            # 只取一次时钟，后续判断与计算复用
+            now = _time()
+
+            # 先查进程内缓存，同一延迟窗口内的重复事件完全不落盘；锁文件仍是跨进程的权威状态
+            pending_rt = self._pending_runtimes.get(target_path_hash)
+            if pending_rt is not None and now < pending_rt:
+                # 条目并入已排队的批次，到点一起刷新
+                with self._pending_lock:
+                    self._pending_items.setdefault(target_path_hash, []).append(items[0])
+                log_debug(f"当前目录 [{lock_target}] 已有任务等待执行，本次并入批次.")
+                return
+
+            lock_path = os.path.join(self._lock_dir_str, target_path_hash + ".lock")
+            log_debug(f"锁定文件路径: {lock_path}")
 
             try:
-                # 如果存在该文件，检查是否达到定时任务执行时间，如果没有达到，则说明未来某一时刻这个任务将被执行，直接返回
-                if lock_path.exists():
-                    with lock_path.open("r") as f:
-                        content = f.read()
-                        if content:
-                            lock_time = float(content)
-                            if time.time() < lock_time:
-                                lock_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(lock_time))
-                                logger.info(f"当前目录 [{target_path}] 已有任务等待执行，将在 {lock_time_str} 进行刷新，本次取消.")
-                                return
-
-                lock_path.parent.mkdir(parents=True, exist_ok=True)
-                lock_path.touch(exist_ok=True)
-                run_time = time.time() + delay
-                run_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(run_time))
-                with lock_path.open("w") as f:
-                    f.write(str(run_time))
-                logger.info(f"目录 [{target_path}] 刷新任务将于 {run_time_str} 执行")
+                # 执行时间直接记在锁文件的 mtime 上，检查只要一次 stat，无需打开文件解析内容
+                try:
+                    lock_time = os.path.getmtime(lock_path)
+                except FileNotFoundError:
+                    lock_time = 0.0
+                if now < lock_time:
+                    # 磁盘上有锁但内存没记录（重启或缓存被清），记回缓存并把条目并入批次，
+                    # 同时确保本进程有对应的定时任务接手
+                    self._pending_runtimes[target_path_hash] = lock_time
+                    with self._pending_lock:
+                        self._pending_items.setdefault(target_path_hash, []).append(items[0])
+                    self._scheduler.add_job(self.__flush_pending, "date",
+                                            run_date=datetime.fromtimestamp(lock_time, tz=pytz.timezone(settings.TZ)),
+                                            args=[target_path_hash],
+                                            id=target_path_hash,
+                                            replace_existing=True)
+                    log_debug(f"当前目录 [{lock_target}] 已有任务等待执行，"
+                              f"将在 {_strftime('%Y-%m-%d %H:%M:%S', _localtime(lock_time))} 进行刷新，本次并入批次.")
+                    return
+                run_time = now + self._delay
+                os.close(os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
+                os.utime(lock_path, (run_time, run_time))
+                self._pending_runtimes[target_path_hash] = run_time
+                run_time_str = _strftime("%Y-%m-%d %H:%M:%S", _localtime(run_time))
+                log_info(f"目录 [{lock_target}] 刷新任务将于 {run_time_str} 执行")
             except Exception as e:
-                logger.info(f"锁定失败，刷新任务继续执行，失败原因: {e}")
+                # 锁不可用时失去跨事件去重，但仍按设定延迟执行刷新
+                log_info(f"锁定失败，仍延迟 {self._delay} 秒后刷新，失败原因: {e}")
+                self._scheduler.add_job(self.__do_refresh, "date",
+                                        run_date=datetime.fromtimestamp(now + self._delay, tz=pytz.timezone(settings.TZ)),
+                                        args=[items])
+                return
+            else:
+                # 同一目录延迟窗口内的事件先汇总，到点后按目录各自批量刷新，不再阻塞事件处理线程
+                with self._pending_lock:
+                    self._pending_items.setdefault(target_path_hash, []).append(items[0])
+                self._scheduler.add_job(self.__flush_pending, "date",
+                                        run_date=datetime.fromtimestamp(run_time, tz=pytz.timezone(settings.TZ)),
+                                        args=[target_path_hash],
+                                        id=target_path_hash,
+                                        replace_existing=True)
+                log_info(f"延迟 {self._delay} 秒后刷新媒体库... ")
+                return
 
-            logger.info(f"延迟 {self._delay} 秒后刷新媒体库... ")
-            time.sleep(float(self._delay))
+        self.__do_refresh(items)
 
-        
-        items = [
-            RefreshMediaItem(
-                title=mediainfo.title,
-                year=mediainfo.year,
-                type=mediainfo.type,
-                category=mediainfo.category,
-                target_path=Path(transferinfo.target_diritem.path)
-            )
-        ]
+    def __flush_pending(self, key: str):
+        """
+        刷新指定加锁目录在延迟窗口内积累的条目
+        """
+        with self._pending_lock:
+            pending = self._pending_items.pop(key, None)
+        if pending:
+            self.__do_refresh(pending)
 
-        for name, service in self.service_infos.items():
-            if hasattr(service.instance, 'refresh_library_by_items'):
+    def __do_refresh(self, items: List[RefreshMediaItem]):
+        """
+        刷新媒体库
+        """
+        service_infos = self.service_infos
+        if not service_infos:
+            return
+        for name, service in service_infos.items():
+            cap = self._service_caps.get(name)
+            if cap == "items":
                 service.instance.refresh_library_by_items(items)
-            elif hasattr(service.instance, 'refresh_root_library'):
+            elif cap == "root":
                 # FIXME Jellyfin未找到刷新单个项目的API
                 service.instance.refresh_root_library()
             else:
                 logger.warning(f"{name} 不支持刷新")
 
+    def __gc_locks(self):
+        """
+        清理一小时前的锁文件，锁目录稳定在最近一小时的工作集大小
+        """
+        now = time.time()
+        expire_before = now - 3600
+        try:
+            with os.scandir(self._lock_dir_str) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file() and entry.stat().st_mtime < expire_before:
+                            os.unlink(entry.path)
+                    except OSError:
+                        continue
+        except OSError as e:
+            logger.debug(f"清理锁目录失败: {e}")
+        # 进程内缓存同步清掉已过期的条目；原地删除，避免换新字典时丢掉并发写入
+        if self._pending_runtimes:
+            with self._pending_lock:
+                expired = [key for key, run_time in self._pending_runtimes.items() if run_time <= now]
+                for key in expired:
+                    del self._pending_runtimes[key]
+
     def stop_service(self):
         """
         退出插件
         """
-        pass
+        try:
+            if self._scheduler:
+                self._scheduler.remove_all_jobs()
+                if self._scheduler.running:
+                    self._scheduler.shutdown()
+                self._scheduler = None
+        except Exception as e:
+            logger.error(f"退出插件失败：{str(e)}")